@@ -0,0 +1,5 @@
+-- Supports the lookups of active rules for an exact address (existing entries, superseding, canceling). Whether a rule
+-- has ended can't be part of the predicate, since utcnow() isn't immutable, but nullified rules can be left out.
+CREATE INDEX blocking_rule_active_address_idx
+          ON __SCHEMA__.blocking_rule (br_type, br_address)
+       WHERE br_nullification_type IS NULL;
@@ -0,0 +1,5 @@
+-- Supports the lookups of active rules that overlap a given address (&&), which a B-tree index can't handle.
+CREATE INDEX blocking_rule_active_address_overlap_idx
+          ON __SCHEMA__.blocking_rule
+       USING gist (br_address inet_ops)
+       WHERE br_nullification_type IS NULL;
@@ -0,0 +1,5 @@
+-- Supports the lookups of all active rules of a given type, which are ordered by creation. Expired rules still have to
+-- be filtered out using br_end, since utcnow() can't be used in the predicate of an index.
+CREATE INDEX blocking_rule_active_created_idx
+          ON __SCHEMA__.blocking_rule (br_type, br_created, br_id)
+       WHERE br_nullification_type IS NULL;
@@ -0,0 +1,21 @@
+-- Lets the instances of blockip that cache the active rules know that they need to fetch them again. The payload is
+-- the type of the rule that changed. (PostgreSQL only delivers identical notifications from a transaction once.)
+CREATE FUNCTION __SCHEMA__.notify_blocking_rule_changed()
+        RETURNS trigger
+       LANGUAGE plpgsql
+             AS $$
+                BEGIN
+                    IF TG_OP = 'DELETE' THEN
+                        PERFORM pg_notify('blocking_rule_changed', OLD.br_type::text);
+                    ELSE
+                        PERFORM pg_notify('blocking_rule_changed', NEW.br_type::text);
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$;
+
+CREATE TRIGGER blocking_rule_changed
+         AFTER INSERT OR UPDATE OR DELETE
+            ON __SCHEMA__.blocking_rule
+           FOR EACH ROW
+       EXECUTE PROCEDURE __SCHEMA__.notify_blocking_rule_changed();
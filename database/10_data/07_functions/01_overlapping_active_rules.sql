@@ -0,0 +1,18 @@
+-- Returns the active rules of the given type that have at least one IP address in common with the given address. Used
+-- by all queries that look for overlapping or conflicting rules. Since it is a simple STABLE SQL function, PostgreSQL
+-- inlines it into the calling query, so the overlap index can still be used.
+--
+-- (This lives here rather than in 02_functions because the body of an SQL function is checked when the function is
+-- created, so the table needs to exist.)
+CREATE FUNCTION __SCHEMA__.overlapping_active_rules(rule_type __SCHEMA__.blocking_rule_type, address cidr)
+        RETURNS SETOF __SCHEMA__.blocking_rule
+         STABLE
+       LANGUAGE sql
+             AS $$
+                SELECT *
+                  FROM __SCHEMA__.blocking_rule
+                 WHERE br_type = rule_type
+                   AND (br_end IS NULL OR br_end > __SCHEMA__.utcnow())
+                   AND br_nullification_type IS NULL
+                   AND br_address && address;
+                $$;
@@ -8,7 +8,8 @@ sys.path.append('src/')
 
 import utilities
 
-SQL_IDENTIFIER_PATTERN = re.compile(r'(?ui)^(?:\w(?<![0-9])[\w$]*|"(?:[^"\0]|"")+")*$')
+SQL_IDENTIFIER_PATTERN = re.compile(r'(?ui)(?:\w(?<![0-9])[\w$]*|"(?:[^"\0]|"")+")*')
+PLACEHOLDER_PATTERN = re.compile(r'__([A-Z_]+?)__')
 SQL_FILE_BASE_PATH = pathlib.Path('database')
 CREATE_SCHEMA_FILE_PATH = SQL_FILE_BASE_PATH / '10_data' / '00_create_schema.sql'
 
@@ -42,33 +43,31 @@ def create_schema(context):
     if context.schema:
         with CREATE_SCHEMA_FILE_PATH.open() as create_schema_file:
             sql = create_schema_file.read()
-    sql = sql.replace('__SCHEMA__', context.schema)
-    sql = sql.replace('__MAIN_ROLE__', context.main_role)
-    sql = sql.replace('__READ_ROLE__', context.read_role)
-    sql = sql.replace('__WRITE_ROLE__', context.write_role)
-    sql = sql.replace('__DATA_USAGE_ROLE__', context.data_usage_role)
+    sql = fill_in_placeholders(sql, {
+        'SCHEMA': context.schema,
+        'MAIN_ROLE': context.main_role,
+        'READ_ROLE': context.read_role,
+        'WRITE_ROLE': context.write_role,
+        'DATA_USAGE_ROLE': context.data_usage_role,
+    })
     execute_sql(context, sql)
 
 
 ### CREATING THE OTHER STUFF ###
 
 def create_other_stuff(context):
-    for path in sql_files(SQL_FILE_BASE_PATH):
-        with path.open() as sql_file:
-            sql = sql_file.read()
-        if context.schema:
-            sql = sql.replace('__SCHEMA__', context.schema)
-        else:
-            sql = sql.replace('__SCHEMA__.', '')
-        execute_sql(context, sql)
+    # Everything is sent in one go, so that psql only needs to be started (and connect to the database) once.
+    sql = '\n'.join(path.read_text() for path in sql_files(SQL_FILE_BASE_PATH))
+    if context.schema:
+        sql = fill_in_placeholders(sql, {'SCHEMA': context.schema})
+    else:
+        sql = sql.replace('__SCHEMA__.', '')
+    execute_sql(context, sql)
 
 
 def sql_files(base_path):
-    for path in base_path.iterdir():
-        if path.is_dir():
-            yield from sql_files(path)
-        elif path.is_file() and path.suffix == '.sql' and path.name != '00_create_schema.sql':
-            yield path
+    # The files need to be executed in lexicographic order, so that, e.g., types are created before the tables.
+    return (path for path in sorted(base_path.rglob('*.sql')) if path.name != CREATE_SCHEMA_FILE_PATH.name)
 
 
 ### CONTEXT ###
@@ -93,17 +92,23 @@ class Context:
 
     def check(self):
         if self.schema:
-            if not SQL_IDENTIFIER_PATTERN.search(self.schema):
+            is_identifier = SQL_IDENTIFIER_PATTERN.fullmatch
+            if not is_identifier(self.schema):
                 print('The schema name {} does not look like a valid PostgreSQL identifer.'.format(self.schema))
                 sys.exit(2)
             for role in (self.main_role, self.read_role, self.write_role, self.data_usage_role):
-                if not SQL_IDENTIFIER_PATTERN.search(role):
+                if not is_identifier(role):
                     print('The role name {} does not look like a valid PostgreSQL identifer.'.format(role))
                     sys.exit(2)
 
 
 ### UTILITY FUNCTIONS ###
 
+def fill_in_placeholders(sql, values):
+    # Replaces placeholders like __SCHEMA__ with values['SCHEMA'] in a single pass. Unknown placeholders are kept.
+    return PLACEHOLDER_PATTERN.sub(lambda match: values.get(match.group(1), match.group(0)), sql)
+
+
 def is_local_host(host):
     # Yes, this is a simplification...
     return host in ('localhost', '127.0.0.1', '::1')
@@ -1,11 +1,20 @@
 """
 Holds some global context that would be difficult to get to where it's needed if it weren't here. Note that these
 remain constant during the application's lifetime.
-"""
 
-import flask
+The Flask application `app` is only created when it is first accessed, so that scripts that merely need the other
+values don't pay for importing and setting up Flask.
+"""
 
-app = flask.Flask(__name__)
 logger = None
 arguments = None
 settings = None
+
+
+def __getattr__(name):
+    if name == 'app':
+        import flask
+        global app
+        app = flask.Flask(__name__)
+        return app
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
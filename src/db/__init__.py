@@ -8,8 +8,11 @@ import ipaddress
 import psycopg2
 import psycopg2.errorcodes
 import psycopg2.extensions
-import psycopg2.extras
+import psycopg2.pool
 import re
+import select
+import threading
+import time
 
 import errors
 import utilities
@@ -17,16 +20,30 @@ import utilities
 
 ### CONNECTIONS ###
 
+POOL_MIN_CONNECTIONS = 2
+DEFAULT_POOL_SIZE = 10
+DEFAULT_APPLICATION_NAME = 'blockip'
+
+connection_pool = None
+connection_pool_lock = threading.Lock()
+
+
 def with_connection(f):
     """
     A decorator that ensures that a psycopg2 connection is passed to the decorated function.
 
     If the first argument passed to the decorated function is a connection, the function is called as normal.
-    Otherwise, a new connection is created, prepended to the positional arguments, and passed to the decorated
-    function.
+    Otherwise, a connection is taken from the connection pool, prepended to the positional arguments, and passed to
+    the decorated function. The transaction is committed (or rolled back, if the decorated function raises an
+    exception) before the connection is returned to the pool (see `call_in_transaction()`).
 
     That is, a decorated function `f(connection, p)` can be called by outside code as `f(p)`, but decorated functions
-    can pass their connections to other decorated functions so that only one connection object will be created.
+    can pass their connections to other decorated functions so that only one connection object will be used.
+
+    If the decorated function fails after executing a statement that had been prepared on the connection earlier, the
+    connection's prepared statements are discarded and the function is called once more in a new transaction, since
+    the plans of prepared statements can go stale when the database objects they refer to are replaced (by a schema
+    migration, for instance).
     """
 
     @functools.wraps(f)
@@ -35,48 +52,292 @@ def with_connection(f):
             return f(*args, **kwargs)
         else:
             try:
-                with create_connection() as connection:
-                    return f(connection, *args, **kwargs)
+                pool = get_connection_pool()
+                connection = pool.getconn()
+            except (psycopg2.OperationalError, psycopg2.pool.PoolError) as e:
+                raise CannotTalkToDatabase(original_message=str(e))
+            connection.prepared_statement_failed = False
+            broken = False
+            try:
+                try:
+                    return call_in_transaction(connection, f, *args, **kwargs)
+                except psycopg2.Error:
+                    if not connection.prepared_statement_failed:
+                        raise
+                    # The transaction has been rolled back by now, so the decorated function can safely be called again.
+                    connection.discard_prepared_statements()
+                    return call_in_transaction(connection, f, *args, **kwargs)
             except psycopg2.OperationalError as e:
+                broken = True
                 raise CannotTalkToDatabase(original_message=str(e))
+            finally:
+                # Connections with broken sockets are closed rather than handed out again.
+                pool.putconn(connection, close=broken or bool(connection.closed))
 
     return wrapper
 
 
+def call_in_transaction(connection, f, *args, **kwargs):
+    """
+    Calls `f(connection, *args, **kwargs)` in a transaction that is committed if `f` returns and rolled back if it
+    raises an exception. Once the transaction has been committed, calls the functions `f` has registered with
+    `connection.after_commit()`.
+    """
+    connection.commit_callbacks = []
+    with connection:
+        result = f(connection, *args, **kwargs)
+    for callback in connection.commit_callbacks:
+        callback()
+    return result
+
+
 def is_connection(o):
     """Indicates whether the given object is a psycopg2 connection."""
     return isinstance(o, psycopg2._psycopg.connection)
 
 
-def create_connection():
-    """Creates a new psycopg2 connection using the settings from the configuration file."""
-    return psycopg2.connect(
-        host=context.settings.get('db', 'host'),
-        database=context.settings.get('db', 'database'),
-        user=context.settings.get('db', 'user'),
-        password=context.settings.get('db', 'password'),
+def get_connection_pool():
+    """Returns the connection pool, creating it on first use (when the settings from the configuration are known)."""
+    global connection_pool
+    if connection_pool is None:
+        with connection_pool_lock:
+            if connection_pool is None:
+                connection_pool = create_connection_pool()
+    return connection_pool
+
+
+def create_connection_pool():
+    """Creates a new pool of psycopg2 connections using the settings from the configuration file."""
+    return ConnectionPool(
+        minconn=POOL_MIN_CONNECTIONS,
+        maxconn=context.settings.getint('db', 'pool_size', fallback=DEFAULT_POOL_SIZE),
+        connection_factory=Connection,
+        **get_connection_parameters()
     )
 
 
+def get_connection_parameters():
+    """Returns the connection parameters from the configuration file as keyword arguments for `psycopg2.connect()`."""
+    return {
+        'host': context.settings.get('db', 'host'),
+        'database': context.settings.get('db', 'database'),
+        'user': context.settings.get('db', 'user'),
+        'password': context.settings.get('db', 'password'),
+        'application_name': context.settings.get('db', 'application_name', fallback=DEFAULT_APPLICATION_NAME),
+    }
+
+
+class ConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """
+    A thread-safe psycopg2 connection pool that makes callers wait for a connection to be returned when all of its
+    connections are in use, rather than raising a `PoolError` like `ThreadedConnectionPool` does.
+    """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None):
+        self.slots.acquire()
+        try:
+            return super().getconn(key)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self.slots.release()
+
+
+class Connection(psycopg2.extensions.connection):
+    """
+    A psycopg2 connection that knows whether statements should be prepared on it, keeps track of the names of the
+    statements that have been prepared on it (and of whether one of them has failed), and returns timestamps as
+    ISO-formatted text (see `TIMESTAMP_AS_TEXT`). Functions can also be registered to be called once the current
+    transaction has been committed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepare_statements = context.settings.getboolean('db', 'prepare_statements', fallback=True)
+        self.prepared_statements = set()
+        self.prepared_statement_failed = False
+        self.commit_callbacks = []
+        psycopg2.extensions.register_type(TIMESTAMP_AS_TEXT, self)
+        # The text representation of timestamps depends on the session's DateStyle, which needs to be ISO. (This is set
+        # here rather than through the `options` connection parameter, which PgBouncer rejects by default.)
+        if not self.get_parameter_status('DateStyle').startswith('ISO'):
+            with self.cursor() as cursor:
+                cursor.execute('SET DateStyle TO ISO')
+            self.commit()
+
+    def discard_prepared_statements(self):
+        """Deallocates all statements prepared on this connection, so that they are prepared anew when next used."""
+        with self.cursor() as cursor:
+            cursor.execute('DEALLOCATE ALL')
+        self.prepared_statements.clear()
+        self.prepared_statement_failed = False
+
+    def after_commit(self, callback):
+        """
+        Registers a function that is called without arguments once the current transaction has been committed by
+        `with_connection()`. The function is not called if the transaction is rolled back.
+        """
+        self.commit_callbacks.append(callback)
+
+
+# All timestamps that blockip deals with are `timestamp(0)` values in UTC, whose text representation ("2014-12-12
+# 12:00:01") is exactly what ends up in the JSON responses, so there's no point in parsing them into datetime objects
+# only to have them formatted again.
+TIMESTAMP_OID = 1114
+TIMESTAMP_AS_TEXT = psycopg2.extensions.new_type((TIMESTAMP_OID,), 'TIMESTAMP_AS_TEXT', lambda value, cursor: value)
+
+
+### NOTIFICATIONS ###
+
+LISTENER_POLL_INTERVAL = 60  # seconds
+LISTENER_RETRY_INTERVAL = 10  # seconds
+
+# Makes sure that a listener notices if the database goes away without closing the connection properly.
+LISTENER_KEEPALIVE_PARAMETERS = {
+    'keepalives': 1,
+    'keepalives_idle': 30,
+    'keepalives_interval': 10,
+    'keepalives_count': 3,
+}
+
+
+def start_listener(channel, callback, on_reset):
+    """
+    Starts a daemon thread that listens for notifications on the given channel, using a connection of its own, and
+    calls `callback` with the payload of each notification it receives.
+
+    Notifications that are sent while the listener isn't connected are lost, so `on_reset` is called with `True` once
+    the listener has started listening, and with `False` whenever it has lost its connection. (The listener tries to
+    reconnect every `LISTENER_RETRY_INTERVAL` seconds.)
+    """
+    thread = threading.Thread(target=listen, args=(channel, callback, on_reset), name='listener-' + channel)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def listen(channel, callback, on_reset):
+    """Does the actual work for `start_listener()`. Never returns."""
+    while True:
+        try:
+            connection = psycopg2.connect(**get_connection_parameters(), **LISTENER_KEEPALIVE_PARAMETERS)
+            try:
+                connection.autocommit = True
+                with connection.cursor() as cursor:
+                    cursor.execute('LISTEN {};'.format(channel))
+                context.logger.info('Listening for notifications on channel %s.', channel)
+                on_reset(True)
+                while True:
+                    select.select([connection], [], [], LISTENER_POLL_INTERVAL)
+                    connection.poll()
+                    while connection.notifies:
+                        callback(connection.notifies.pop(0).payload)
+            finally:
+                connection.close()
+        except Exception:
+            context.logger.exception('Stopped listening for notifications on channel %s.', channel)
+        on_reset(False)
+        time.sleep(LISTENER_RETRY_INTERVAL)
+
+
 ### EXECUTING QUERIES ###
 
-def execute_query(connection, query, parameters=(), mapper=utilities.identity):
+STREAM_CURSOR_NAME = 'blockip_stream'
+STREAM_BATCH_SIZE = 2000
+
+
+def execute_query(connection, query, parameters=(), mapper=utilities.identity, stream=False):
     """
     Executes the given query with the given parameters using the given connection, maps the returned rows with the
-    given mapper function, and returns the result.
+    given mapper function, and returns the result. Returns an empty list for statements that don't return rows.
+
+    If `stream` is given, the rows are fetched from a server-side cursor in batches of `STREAM_BATCH_SIZE` rows rather
+    than being transferred all at once, so that large result sets are never held in memory twice. This only works for
+    plain `SELECT` queries.
     """
     query = add_schema(query)
     context.logger.debug('Executing query\n%s\nwith parameters %s.', query, parameters)
-    with connection.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor) as cursor:
+    cursor_name = STREAM_CURSOR_NAME if stream else None
+    with connection.cursor(cursor_name) as cursor:
+        cursor.itersize = STREAM_BATCH_SIZE
         try:
             cursor.execute(query, parameters)
         except psycopg2.Error as e:
             raise wrap_expected_errors(e)
-        return [mapper(row) for row in cursor.fetchall()]
+        if not stream and cursor.description is None:
+            return []
+        return [mapper(row) for row in cursor]
+
+
+def execute_prepared_query(connection, name, query, parameters=(), mapper=utilities.identity):
+    """
+    As `execute_query()`, but has the database prepare the given query under the given name the first time it is
+    executed on the given connection, so that it is only parsed and planned once per connection. The query must use
+    named parameters (`%(name)s`).
+
+    If the configuration setting `prepare_statements` from the `db` section is turned off (because the connections go
+    through a proxy that doesn't keep sessions, for instance), the query is simply executed as is. Each connection reads
+    that setting once, when it is opened.
+
+    If executing a statement that was prepared in an earlier transaction fails with an unexpected error, the connection
+    is flagged, so that `with_connection()` can discard its prepared statements and try again.
+    """
+    if not connection.prepare_statements:
+        return execute_query(connection, query, parameters, mapper)
+    prepare_statement, execute_statement = get_prepared_query_statements(name, query)
+    if name not in connection.prepared_statements:
+        execute_query(connection, prepare_statement)
+        connection.prepared_statements.add(name)
+        return execute_query(connection, execute_statement, parameters, mapper)
+    try:
+        return execute_query(connection, execute_statement, parameters, mapper)
+    except psycopg2.Error as e:
+        if not isinstance(e, psycopg2.OperationalError):
+            connection.prepared_statement_failed = True
+        raise
+
+
+PATTERN_NAMED_PARAMETER = re.compile(r'%\((\w+)\)s')
+
+
+@functools.lru_cache(maxsize=None)
+def get_prepared_query_statements(name, query):
+    """
+    Returns a tuple `(prepare_statement, execute_statement)` for the given query. The former prepares the query under
+    the given name, with its named parameters replaced by positional ones, and the latter executes the prepared query,
+    passing on the named parameters in the appropriate order.
+    """
+    parameter_names = []
+
+    def replace_parameter(match):
+        if match.group(1) not in parameter_names:
+            parameter_names.append(match.group(1))
+        return '${}'.format(parameter_names.index(match.group(1)) + 1)
+
+    body = PATTERN_NAMED_PARAMETER.sub(replace_parameter, query).strip().rstrip(';')
+    prepare_statement = 'PREPARE {} AS\n{};'.format(name, body)
+    arguments = ', '.join('%({})s'.format(parameter_name) for parameter_name in parameter_names)
+    execute_statement = 'EXECUTE {}({});'.format(name, arguments) if arguments else 'EXECUTE {};'.format(name)
+    return prepare_statement, execute_statement
 
 
+@functools.lru_cache(maxsize=256)
 def add_schema(query):
-    """Relaces all instances of the __SCHEMA__ placeholder in the given query with the actual schema name."""
+    """
+    Relaces all instances of the __SCHEMA__ placeholder in the given query with the actual schema name.
+
+    The results are cached, since the queries are fixed templates and the schema doesn't change while the application
+    is running.
+    """
     schema = context.settings.get('db', 'schema', fallback='')
     schema = schema + '.' if schema else schema
     return query.replace('__SCHEMA__.', schema)
@@ -93,10 +354,27 @@ def wrap_expected_errors(e):
     or if the PostgreSQL folks change the format of their error messages, but blockip will just fall back to more
     generic error reporting in that case, so this is still better than not trying.
     """
-    return wrap_malformed_timestamp_error(e) \
-        or wrap_malformed_interval_error(e) \
-        or wrap_empty_duration_error(e) \
-        or e
+    if e.pgcode in MATCHERS_BY_PGCODE:
+        match = match_expected_error(e.pgcode, str(e))
+        if match:
+            error_class, parameters = match
+            return error_class(**parameters)
+    return e
+
+
+@functools.lru_cache(maxsize=256)
+def match_expected_error(pgcode, message):
+    """
+    Returns a tuple `(error_class, parameters)` describing the custom exception for the expected error with the given
+    error code and message, or `None` if the error isn't one of the expected errors.
+
+    The results are cached, since the same bad input tends to be sent over and over again (by scripts, say). Note that
+    the exceptions themselves aren't cached, since raising an exception modifies it.
+    """
+    for matcher in MATCHERS_BY_PGCODE[pgcode]:
+        match = matcher(message)
+        if match:
+            return match
 
 
 # PATTERNS
@@ -106,30 +384,35 @@ PATTERN_MALFORMED_INTERVAL = re.compile(r'invalid input syntax for type interval
 PATTERN_SHORT_DURATION = re.compile(r'new row for relation "blocking_rule" violates check constraint "br_valid_duration"')
 
 
-# WRAPPERS
+# MATCHERS
 
-def wrap_malformed_timestamp_error(e):
-    """Returns a `MalformedTimestamp` exception if the given exception is due to a invalid timestamp value."""
-    if e.pgcode == psycopg2.errorcodes.INVALID_DATETIME_FORMAT:
-        match = PATTERN_MALFORMED_TIMESTAMP.search(str(e))
-        if match:
-            return MalformedTimestamp(timestamp=match.group(2))
+def match_malformed_timestamp_error(message):
+    """Matches error messages that are due to an invalid timestamp value."""
+    match = PATTERN_MALFORMED_TIMESTAMP.search(message)
+    if match:
+        return MalformedTimestamp, {'timestamp': match.group(2)}
 
 
-def wrap_malformed_interval_error(e):
-    """Returns a `MalformedInterval` exception if the given exception is due to a invalid interval value."""
-    if e.pgcode == psycopg2.errorcodes.INVALID_DATETIME_FORMAT:
-        match = PATTERN_MALFORMED_INTERVAL.search(str(e))
-        if match:
-            return MalformedInterval(interval=match.group(1))
+def match_malformed_interval_error(message):
+    """Matches error messages that are due to an invalid interval value."""
+    match = PATTERN_MALFORMED_INTERVAL.search(message)
+    if match:
+        return MalformedInterval, {'interval': match.group(1)}
 
 
-def wrap_empty_duration_error(e):
-    """Returns an `EmptyDuration` exception if the given exception is due to the duration being empty."""
-    if e.pgcode == psycopg2.errorcodes.CHECK_VIOLATION:
-        match = PATTERN_SHORT_DURATION.search(str(e))
-        if match:
-            return EmptyDuration()
+def match_empty_duration_error(message):
+    """Matches error messages that are due to the duration being empty."""
+    match = PATTERN_SHORT_DURATION.search(message)
+    if match:
+        return EmptyDuration, {}
+
+
+# Maps the error codes of expected errors to the matchers that might apply, so that the error message only has to be
+# examined when the error code matches.
+MATCHERS_BY_PGCODE = {
+    psycopg2.errorcodes.INVALID_DATETIME_FORMAT: (match_malformed_timestamp_error, match_malformed_interval_error),
+    psycopg2.errorcodes.CHECK_VIOLATION: (match_empty_duration_error,),
+}
 
 
 # ERRORS
@@ -159,10 +442,13 @@ class CannotTalkToDatabase(errors.EnvironmentError):
 
 ### REGISTER ADAPTERS ###
 
-# Tell psycopg2 how to deal with `ipaddress` classes that are passed as parameters to queries.
+# Tell psycopg2 how to deal with `ipaddress` classes that are passed as parameters to queries. The same addresses tend
+# to be used over and over again, so the quoted literals are cached. (`getquoted()` returns bytes, which `AsIs` would
+# render as a Python bytes literal, so they need to be decoded again.)
 
+@functools.lru_cache(maxsize=4096)
 def str_adapter(o):
-    return psycopg2.extensions.QuotedString(str(o))
+    return psycopg2.extensions.AsIs(psycopg2.extensions.QuotedString(str(o)).getquoted().decode('ascii'))
 
 
 psycopg2.extensions.register_adapter(ipaddress.IPv4Network, str_adapter)
@@ -1,13 +1,41 @@
+import collections
+import datetime
+import functools
+import threading
+import time
+
+import context
 import db
 
 
 # GET ACTIVE RULES
 
 def get_active_rules_by_type(connection, type):
+    """
+    Returns the blocking rules of the given type that are currently active, from the cache if possible (see below).
+    The returned list must not be modified.
+    """
+    cache_time = context.settings.getfloat('db', 'active_rules_cache_time', fallback=0)
+    if cache_time <= 0:
+        return fetch_active_rules_by_type(connection, type)
+    ensure_active_rules_listener()
+    with active_rules_cache_lock:
+        cached = active_rules_cache.get(type)
+        generation = active_rules_cache_generation
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    rules = fetch_active_rules_by_type(connection, type)
+    with active_rules_cache_lock:
+        if active_rules_cache_enabled and active_rules_cache_generation == generation:
+            active_rules_cache[type] = (get_active_rules_expiration_time(rules, cache_time), rules)
+    return rules
+
+
+def fetch_active_rules_by_type(connection, type):
     """Fetches the blocking rules of the given type that are currently active from the database."""
     query = GET_ACTIVE_RULES_BY_TYPE_QUERY
     parameters = {'type': type}
-    return db.execute_query(connection, query, parameters, dict_from_rule_row)
+    return db.execute_query(connection, query, parameters, dict_from_active_rule_row, stream=True)
 
 
 GET_ACTIVE_RULES_BY_TYPE_QUERY = """
@@ -26,78 +54,141 @@ GET_ACTIVE_RULES_BY_TYPE_QUERY = """
 """
 
 
-# ADD RULE
-
-def add_rule_simple(connection, type, address, duration, user, comment):
-    """Creates a blocking rule and returns it ID and a dict describing it."""
-    duration_type, duration_value = duration or (None, None)
-    query = durationify(ADD_RULE_QUERY, duration_type)
-    parameters = {'type': type, 'address': address, 'duration': duration_value, 'user': user, 'comment': comment}
-    row = db.execute_query(connection, query, parameters)[0]
-    return row.br_id, dict_from_rule_row(row)
-
-
-ADD_RULE_QUERY = """
-    INSERT INTO __SCHEMA__.blocking_rule
-                (br_address,
-                 br_type,
-                 br_end,
-                 br_created_by,
-                 br_creation_comment)
-         VALUES (%(address)s,
-                 %(type)s,
-                 {duration_snippet},
-                 %(user)s,
-                 %(comment)s)
-      RETURNING br_id,
-                'ACTIVE' AS br_status,
-                br_address,
-                br_end,
-                br_created,
-                br_created_by,
-                br_creation_comment;
-"""
+# ACTIVE RULES CACHE
+
+# The lists of active rules are requested over and over again (by the scripts that keep the firewalls in sync, for
+# instance), but change rarely, so they can be cached for `active_rules_cache_time` seconds (from the `db` section of
+# the configuration file). Whenever a rule is added or changed, the database sends a notification on the channel
+# ACTIVE_RULES_CHANGED_CHANNEL (see 06_triggers), which makes every instance of blockip drop its cached list for the
+# rule's type. Changes made by this instance also drop the list as soon as they have been committed.
+#
+# The cache is only used while the listener for those notifications is connected, since notifications that are sent
+# in the meantime are lost. Also, `active_rules_cache_generation` is incremented whenever a list is dropped, so that
+# a list fetched before a change isn't put into the cache after the change. Entries never outlive the earliest end of
+# the rules they contain.
+
+ACTIVE_RULES_CHANGED_CHANNEL = 'blocking_rule_changed'
+
+active_rules_cache = {}  # Maps rule types to tuples `(expiration_time, rules)`.
+active_rules_cache_generation = 0
+active_rules_cache_enabled = False
+active_rules_cache_lock = threading.Lock()
+active_rules_listener = None
+
+
+def ensure_active_rules_listener():
+    """Starts listening for changes to the rules, unless that has already happened."""
+    global active_rules_listener
+    if active_rules_listener is None:
+        with active_rules_cache_lock:
+            if active_rules_listener is None:
+                active_rules_listener = db.start_listener(
+                    ACTIVE_RULES_CHANGED_CHANNEL, invalidate_active_rules, reset_active_rules_cache)
+
+
+def invalidate_active_rules(type):
+    """Drops the cached list of active rules of the given type."""
+    global active_rules_cache_generation
+    with active_rules_cache_lock:
+        active_rules_cache.pop(type, None)
+        active_rules_cache_generation += 1
 
 
-# CANCEL RULE
+def invalidate_active_rules_after_commit(connection, type):
+    """
+    Drops the cached list of active rules of the given type once the current transaction has been committed. (Dropping
+    it earlier would let another request put the rules from before the change back into the cache.)
+    """
+    connection.after_commit(functools.partial(invalidate_active_rules, type))
 
-def cancel_rule_simple(connection, type, address, user, comment):
-    """Performs the actual cancelation of the whitelist entries for the given address."""
-    query = CANCEL_RULE_QUERY
+
+def reset_active_rules_cache(listening):
+    """Empties the cache of active rules, and enables or disables it depending on whether changes can be detected."""
+    global active_rules_cache_enabled, active_rules_cache_generation
+    with active_rules_cache_lock:
+        active_rules_cache.clear()
+        active_rules_cache_generation += 1
+        active_rules_cache_enabled = listening
+
+
+def get_active_rules_expiration_time(rules, cache_time):
+    """Returns the (monotonic) time at which a cached list of the given active rules needs to be fetched again."""
+    seconds = cache_time
+    # The ends are timestamps in text form (see `db.TIMESTAMP_AS_TEXT`), which sort chronologically.
+    earliest_end = min((rule['end'] for rule in rules if 'end' in rule), default=None)
+    if earliest_end:
+        time_left = datetime.datetime.fromisoformat(earliest_end) - datetime.datetime.utcnow()
+        seconds = min(seconds, time_left.total_seconds())
+    return time.monotonic() + seconds
+
+
+# CANCEL RULES
+
+def cancel_rules(connection, type, address, user, comment):
+    """
+    Cancels the active rules of the given type for the given exact address. Returns a tuple `(canceled_rules,
+    overlapping_rules)` of lists of dicts, where the latter are the active rules of the given type that overlap with
+    the given address and are still in effect. Uses a single query for both.
+    """
     parameters = {'type': type, 'address': address, 'user': user, 'comment': comment}
-    return db.execute_query(connection, query, parameters, dict_from_rule_row)
-
-
-CANCEL_RULE_QUERY = """
-       UPDATE __SCHEMA__.blocking_rule
-          SET br_nullified = __SCHEMA__.utcnow(),
-              br_nullified_by = %(user)s,
-              br_nullification_type = 'CANCELED',
-              br_nullification_comment = %(comment)s
-        WHERE br_type = %(type)s
-          AND (br_end IS NULL OR br_end > __SCHEMA__.utcnow())
-          AND br_nullification_type IS NULL
-          AND br_address = %(address)s
-    RETURNING br_address,
-              'CANCELED' AS br_status,
-              br_end,
-              br_created,
-              br_created_by,
-              br_creation_comment,
-              br_nullified,
-              br_nullified_by,
-              br_nullification_comment;
+    rows = db.execute_prepared_query(connection, 'cancel_rules', CANCEL_RULES_QUERY, parameters)
+    rules = group_rule_rows_by_tag(rows)
+    if rules['CANCELED']:
+        invalidate_active_rules_after_commit(connection, type)
+    return rules['CANCELED'], rules['OVERLAPPING']
+
+
+# As with ADD_BLACKLIST_ENTRY_QUERY, `overlapping` still sees the canceled rules as active, so they're excluded
+# explicitly.
+CANCEL_RULES_QUERY = """
+      WITH canceled AS (
+                  UPDATE __SCHEMA__.blocking_rule
+                     SET br_nullified = __SCHEMA__.utcnow(),
+                         br_nullified_by = %(user)s,
+                         br_nullification_type = 'CANCELED',
+                         br_nullification_comment = %(comment)s
+                   WHERE br_type = %(type)s
+                     AND (br_end IS NULL OR br_end > __SCHEMA__.utcnow())
+                     AND br_nullification_type IS NULL
+                     AND br_address = %(address)s
+               RETURNING br_id,
+                         br_address,
+                         br_end,
+                         br_created,
+                         br_created_by,
+                         br_creation_comment,
+                         br_nullified,
+                         br_nullified_by,
+                         br_nullification_comment
+           ),
+           overlapping AS (
+               SELECT br_address,
+                      br_end,
+                      br_created,
+                      br_created_by,
+                      br_creation_comment
+                 FROM __SCHEMA__.overlapping_active_rules(%(type)s, %(address)s::cidr)
+                WHERE br_id NOT IN (SELECT br_id FROM canceled)
+                  AND EXISTS (SELECT 1 FROM canceled)
+           )
+    SELECT 'CANCELED' AS tag, 'CANCELED' AS br_status, br_address, br_end, br_created, br_created_by,
+           br_creation_comment, br_nullified, br_nullified_by, br_nullification_comment
+      FROM canceled
+ UNION ALL
+    SELECT 'OVERLAPPING', 'ACTIVE', *, NULL::timestamp, NULL::text, NULL::text
+      FROM overlapping;
 """
 
 
 # GET OVERLAPPING ACTIVE RULES
 
 @db.with_connection
-def get_overlapping_active_rules_by_type(connection, type, address, excluded_id=-1):
+def get_overlapping_active_rules_by_type(connection, type, address):
     """Returns all active rules that have at least one IP address in common with the given address."""
     query = GET_OVERLAPPING_ACTIVE_RULES_BY_TYPE_QUERY
-    parameters = {'type': type, 'address': address, 'excluded_id': excluded_id}
-    return db.execute_query(connection, query, parameters, dict_from_rule_row)
+    parameters = {'type': type, 'address': address}
+    name = 'get_overlapping_active_rules_by_type'
+    return db.execute_prepared_query(connection, name, query, parameters, dict_from_active_rule_row)
 
 
 GET_OVERLAPPING_ACTIVE_RULES_BY_TYPE_QUERY = """
@@ -107,50 +198,104 @@ GET_OVERLAPPING_ACTIVE_RULES_BY_TYPE_QUERY = """
            br_created,
            br_created_by,
            br_creation_comment
-      FROM __SCHEMA__.blocking_rule
-     WHERE br_type = %(type)s
-       AND (br_end IS NULL OR br_end > __SCHEMA__.utcnow())
-       AND br_nullification_type IS NULL
-       AND (br_address >> %(address)s OR br_address <<= %(address)s)
-       AND br_id != %(excluded_id)s;
+      FROM __SCHEMA__.overlapping_active_rules(%(type)s, %(address)s::cidr);
 """
 
 
 ### FORMATTING RESULTS ###
 
+# The rows passed to `dict_from_rule_row()` must contain the columns br_status, br_address, br_end, br_created,
+# br_created_by, br_creation_comment, br_nullified, br_nullified_by, br_nullification_comment, and br_type, in that
+# order. Trailing columns can be omitted if they aren't needed, that is, br_nullified and br_nullified_by unless the
+# status is 'SUPERSEDED' or 'CANCELED', br_nullification_comment unless the status is 'CANCELED', and br_type unless
+# the type of the rule should be included. Any extra columns after those are ignored.
+
 def dict_from_rule_row(row):
+    result = DICT_FROM_RULE_ROW_BY_STATUS.get(row[0], dict_from_active_rule_row)(row)
+    if len(row) > 9:
+        result['type'] = row[9]
+    return result
+
+
+# The specialized versions below skip the checks that aren't needed for rows whose shape is known in advance.
+
+def dict_from_active_rule_row(row):
+    """As `dict_from_rule_row()`, but for rules that haven't been nullified, and without the type."""
     result = {
-        'status': row.br_status,
-        'address': row.br_address,
+        'status': row[0],
+        'address': row[1],
         'created': {
-            'at': row.br_created,
-            'by': row.br_created_by,
-            'comment': row.br_creation_comment,
+            'at': row[3],
+            'by': row[4],
+            'comment': row[5],
         }
     }
-    if hasattr(row, 'br_type'):
-        result['type'] = row.br_type
-    if getattr(row, 'br_end', None):
-        result['end'] = row.br_end
-    if row.br_status in ('CANCELED', 'SUPERSEDED'):
-        result['nullified'] = {
-            'at': row.br_nullified,
-            'by': row.br_nullified_by,
-        }
-    if row.br_status == 'CANCELED':
-        result['nullified']['comment'] = row.br_nullification_comment
+    if row[2]:
+        result['end'] = row[2]
     return result
 
 
+def dict_from_canceled_rule_row(row):
+    """As `dict_from_rule_row()`, but for rules that have been canceled, and without the type."""
+    result = dict_from_active_rule_row(row)
+    result['nullified'] = {
+        'at': row[6],
+        'by': row[7],
+        'comment': row[8],
+    }
+    return result
+
+
+def dict_from_superseded_rule_row(row):
+    """As `dict_from_rule_row()`, but for rules that have been superseded, and without the type."""
+    result = dict_from_active_rule_row(row)
+    result['nullified'] = {
+        'at': row[6],
+        'by': row[7],
+    }
+    return result
+
+
+def dict_from_history_row(row):
+    """As `dict_from_rule_row()`, but for rows that contain all columns, including the type."""
+    result = DICT_FROM_RULE_ROW_BY_STATUS.get(row[0], dict_from_active_rule_row)(row)
+    result['type'] = row[9]
+    return result
+
+
+# Rules with other statuses ('ACTIVE', 'ENDED') are handled by `dict_from_active_rule_row()`.
+DICT_FROM_RULE_ROW_BY_STATUS = {
+    'CANCELED': dict_from_canceled_rule_row,
+    'SUPERSEDED': dict_from_superseded_rule_row,
+}
+
+
+def group_rule_rows_by_tag(rows):
+    """
+    Given the rows returned by a query that combines several sets of rules, with each row carrying the name of the set
+    it belongs to in a leading `tag` column, returns a dict that maps the tags to lists of dicts describing the rules
+    in the respective sets. Tags for which there are no rows are mapped to empty lists.
+    """
+    groups = collections.defaultdict(list)
+    for row in rows:
+        groups[row[0]].append(dict_from_rule_row(row[1:]))
+    return groups
+
+
 ### GENERATING QUERIES ###
 
+@functools.lru_cache(maxsize=None)
 def durationify(query, duration_type):
-    """Given a query with a `{duration_snippet}` placeholder, inserts the appropriate SQL snippet for the duration."""
+    """
+    Given a query with a `{duration_snippet}` placeholder, inserts the appropriate SQL snippet for the duration.
+
+    The results are cached, since there are only a handful of queries and duration types. Each variant of a query
+    should be prepared under its own name (see `db.execute_prepared_query()`), since the variants have different plans.
+    """
     return query.format(duration_snippet=DURATION_QUERY_SNIPPETS[duration_type])
 
 
 DURATION_QUERY_SNIPPETS = {
-    None: '%(duration)s',
     'for': '__SCHEMA__.utcnow() + %(duration)s::interval',
     'until': '%(duration)s AT TIME ZONE \'UTC\'',
 }
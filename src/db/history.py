@@ -5,12 +5,11 @@ import db
 def get_overlapping_entries(connection, address):
     query = GET_HISTORY_FOR_ADDRESS_QUERY
     parameters = {'address': address}
-    return db.execute_query(connection, query, parameters, db.common.dict_from_rule_row)
+    return db.execute_query(connection, query, parameters, db.common.dict_from_history_row, stream=True)
 
 
 GET_HISTORY_FOR_ADDRESS_QUERY = """
-      SELECT br_type,
-             (CASE WHEN br_nullification_type IS NOT NULL THEN br_nullification_type::text::__SCHEMA__.blocking_rule_status
+      SELECT (CASE WHEN br_nullification_type IS NOT NULL THEN br_nullification_type::text::__SCHEMA__.blocking_rule_status
                   WHEN br_end IS NOT NULL AND br_end < __SCHEMA__.utcnow() THEN 'ENDED'
                   ELSE 'ACTIVE'
               END) AS br_status,
@@ -21,9 +20,10 @@ GET_HISTORY_FOR_ADDRESS_QUERY = """
              br_creation_comment,
              br_nullified,
              br_nullified_by,
-             br_nullification_comment
+             br_nullification_comment,
+             br_type
         FROM __SCHEMA__.blocking_rule
-       WHERE (br_address >> %(address)s OR br_address <<= %(address)s)
+       WHERE br_address && %(address)s
     ORDER BY br_created ASC,
              br_id ASC;
 """
@@ -20,12 +20,84 @@ def get_active_whitelist_entries(connection):
 
 @db.with_connection
 def add_whitelist_entry(connection, address, user, comment):
-    """Adds a whitelist entry for the given address to the database."""
-    check_for_conflicting_blacklist_entries(connection, address)
-    check_for_existing_whitelist_entries(connection, address)
-    new_id, entry = db.common.add_rule_simple(connection, 'WHITELIST', address, None, user, comment)
-    overlapping_whitelist_entries = get_overlapping_whitelist_entries(connection, address, new_id)
-    return entry, overlapping_whitelist_entries
+    """
+    Adds a whitelist entry for the given address to the database. Returns the new entry and the overlapping entries.
+
+    The checks for conflicting and existing entries, the insertion, and the lookup of overlapping entries are all
+    performed by a single query, so that only one round-trip to the database is needed.
+    """
+    parameters = {'address': address, 'user': user, 'comment': comment}
+    rows = db.execute_prepared_query(connection, 'add_whitelist_entry', ADD_WHITELIST_ENTRY_QUERY, parameters)
+    entries = db.common.group_rule_rows_by_tag(rows)
+    if entries['CONFLICTING']:
+        raise AddressCannotBeWhitelisted(address=address, conflicting_blacklist_entries=entries['CONFLICTING'])
+    if entries['EXISTING']:
+        raise AddressAlreadyWhitelisted(address=address, existing_whitelist_entries=entries['EXISTING'])
+    [new_whitelist_entry] = entries['NEW']
+    db.common.invalidate_active_rules_after_commit(connection, 'WHITELIST')
+    return new_whitelist_entry, entries['OVERLAPPING']
+
+
+# As with ADD_BLACKLIST_ENTRY_QUERY, `overlapping` doesn't see the new entry.
+ADD_WHITELIST_ENTRY_QUERY = """
+      WITH conflicting AS (
+               SELECT br_address,
+                      br_end,
+                      br_created,
+                      br_created_by,
+                      br_creation_comment
+                 FROM __SCHEMA__.overlapping_active_rules('BLACKLIST', %(address)s::cidr)
+           ),
+           existing AS (
+               SELECT br_address,
+                      br_end,
+                      br_created,
+                      br_created_by,
+                      br_creation_comment
+                 FROM __SCHEMA__.blocking_rule
+                WHERE br_type = 'WHITELIST'
+                  AND br_nullification_type IS NULL
+                  AND br_address = %(address)s
+           ),
+           added AS (
+               INSERT INTO __SCHEMA__.blocking_rule
+                           (br_address,
+                            br_type,
+                            br_created_by,
+                            br_creation_comment)
+                    SELECT %(address)s,
+                           'WHITELIST',
+                           %(user)s,
+                           %(comment)s
+                     WHERE NOT EXISTS (SELECT 1 FROM conflicting)
+                       AND NOT EXISTS (SELECT 1 FROM existing)
+                 RETURNING br_address,
+                           br_end,
+                           br_created,
+                           br_created_by,
+                           br_creation_comment
+           ),
+           overlapping AS (
+               SELECT br_address,
+                      br_end,
+                      br_created,
+                      br_created_by,
+                      br_creation_comment
+                 FROM __SCHEMA__.overlapping_active_rules('WHITELIST', %(address)s::cidr)
+                WHERE EXISTS (SELECT 1 FROM added)
+           )
+    SELECT 'CONFLICTING' AS tag, 'ACTIVE' AS br_status, *
+      FROM conflicting
+ UNION ALL
+    SELECT 'EXISTING', 'ACTIVE', *
+      FROM existing
+ UNION ALL
+    SELECT 'NEW', 'ACTIVE', *
+      FROM added
+ UNION ALL
+    SELECT 'OVERLAPPING', 'ACTIVE', *
+      FROM overlapping;
+"""
 
 
 # CANCEL WHITELIST ENTRIES
@@ -33,10 +105,10 @@ def add_whitelist_entry(connection, address, user, comment):
 @db.with_connection
 def cancel_whitelist_entries(connection, address, user, comment):
     """Cancels all whitelist entries for the given address."""
-    canceled_whitelist_entries = db.common.cancel_rule_simple(connection, 'WHITELIST', address, user, comment)
+    results = db.common.cancel_rules(connection, 'WHITELIST', address, user, comment)
+    canceled_whitelist_entries, overlapping_whitelist_entries = results
     if not canceled_whitelist_entries:
         raise AddressNotWhitelisted(address=address)
-    overlapping_whitelist_entries = get_overlapping_whitelist_entries(connection, address)
     return canceled_whitelist_entries, overlapping_whitelist_entries
 
 
@@ -46,32 +118,6 @@ class AddressNotWhitelisted(errors.NothingToDo):
 
 # EXISTING WHITELIST ENTRIES
 
-def check_for_existing_whitelist_entries(connection, address):
-    """Raises `AddressAlreadyWhitelisted` if there's already a whitelist entry for the given exact address."""
-    existing_whitelist_entries = get_existing_whitelist_entries_for_address(connection, address)
-    if any(existing_whitelist_entries):
-        raise AddressAlreadyWhitelisted(address=address, existing_whitelist_entries=existing_whitelist_entries)
-
-
-def get_existing_whitelist_entries_for_address(connection, address):
-    """Fetches existing whitelist entries for the given exact address."""
-    query = GET_EXISTING_WHITELIST_ENTRIES_QUERY
-    parameters = {'address': address}
-    return db.execute_query(connection, query, parameters, db.common.dict_from_rule_row)
-
-
-GET_EXISTING_WHITELIST_ENTRIES_QUERY = """
-    SELECT 'ACTIVE' AS br_status,
-           br_address,
-           br_created,
-           br_created_by,
-           br_creation_comment
-      FROM __SCHEMA__.blocking_rule
-     WHERE br_type = 'WHITELIST'
-       AND br_nullification_type IS NULL
-       AND br_address = %(address)s;
-"""
-
 class AddressAlreadyWhitelisted(errors.NothingToDo):
     message_template = 'The address {address} is already whitelisted.'
     parameters_to_add_to_response = ['existing_whitelist_entries']
@@ -80,20 +126,13 @@ class AddressAlreadyWhitelisted(errors.NothingToDo):
 # OVERLAPPING WHITELIST ENTRIES
 
 @db.with_connection
-def get_overlapping_whitelist_entries(connection, address, excluded_id=-1):
+def get_overlapping_whitelist_entries(connection, address):
     """Returns all active whitelist entries that are have at least one IP address in common with the given address."""
-    return db.common.get_overlapping_active_rules_by_type(connection, 'WHITELIST', address, excluded_id)
+    return db.common.get_overlapping_active_rules_by_type(connection, 'WHITELIST', address)
 
 
 # CONFLICTING BLACKLIST ENTRIES
 
-def check_for_conflicting_blacklist_entries(connection, address):
-    """Raises `AddressCannotBeWhitelisted` if there is a blacklist entry that overlaps with the given address."""
-    conflicting_blacklist_entries = db.blacklist.get_overlapping_blacklist_entries(connection, address)
-    if any(conflicting_blacklist_entries):
-        raise AddressCannotBeWhitelisted(address=address, conflicting_blacklist_entries=conflicting_blacklist_entries)
-
-
 class AddressCannotBeWhitelisted(errors.IntegrityError):
     message_template = 'The address {address} cannot be whitelisted because it\'s already blacklisted.'
     parameters_to_add_to_response = ['conflicting_blacklist_entries']
@@ -12,6 +12,12 @@ import errors
 import permissions
 
 
+### CONFIGURATION ###
+
+DEFAULT_BLACKLIST_DURATION = '8 hours'
+DEFAULT_DURATION = ('for', DEFAULT_BLACKLIST_DURATION)
+
+
 ### ENDPOINT DECORATOR ###
 
 def endpoint(route, method, required_role):
@@ -32,19 +38,20 @@ def endpoint(route, method, required_role):
     """
 
     def decorator(f):
+        # Flask passes the values captured from the route as keyword arguments, so there's no need to inspect the
+        # arguments of each call.
+        takes_address = 'address' in inspect.signature(f).parameters
 
         @functools.wraps(f)
         def wrapper(*args, **kwargs):
-            argument_dict = inspect.getcallargs(f, *args, **kwargs)
-
-            if 'address' in argument_dict:
-                address = parse_address(argument_dict['address'])
-                argument_dict['address'] = address
+            if takes_address:
+                address = parse_address(kwargs['address'])
+                kwargs['address'] = address
                 permissions.check_authorization(required_role, address.num_addresses > 1)
             else:
                 permissions.check_authorization(required_role, False)
 
-            return f(**argument_dict)
+            return f(*args, **kwargs)
 
         return context.app.route(route, methods=[method])(wrapper)
 
@@ -54,7 +61,7 @@ def endpoint(route, method, required_role):
 def parse_address(address):
     """Parses the given IP address into a `ipaddress.IPv{4,6}Network` object. Wrap expected errors."""
     try:
-        return ipaddress.ip_network(address, strict=True)
+        return parse_network(address)
     except ValueError as e:
         if 'has host bits set' in str(e):
             raise HostBitsSet(address=address)
@@ -64,6 +71,15 @@ def parse_address(address):
             raise
 
 
+@functools.lru_cache(maxsize=4096)
+def parse_network(address):
+    """
+    Parses the given IP address into a `ipaddress.IPv{4,6}Network` object. The results are cached, since the same
+    addresses tend to come up again and again, and the network objects are immutable.
+    """
+    return ipaddress.ip_network(address, strict=True)
+
+
 class HostBitsSet(errors.RequestError):
     message_template = 'The IP address "{address}" has host bits set.'
 
@@ -89,7 +105,7 @@ def get_comment():
     if comment:
         return comment
     else:
-        raise endpoints.errors.MissingComment()
+        raise MissingComment()
 
 
 def get_duration():
@@ -97,21 +113,22 @@ def get_duration():
     Returns a tuple `(duration_type, duration_value)`, where `duration_vale` is the value of the `for` or `until`
     form parameter from the current request, and `duration_type` is the name of the parameter that was used.
 
-    Returns `('for', DEFAULT_BLACKLIST_DURATION)` if the request has neither a `for` not an `until` parameter. Raises
+    Returns `DEFAULT_DURATION` if the request has neither a `for` not an `until` parameter. Raises
     `MultipleDurations` if the request has both parameters. Does not raise an error if either parameter has
     an invalid value.
     """
-    for_value = flask.request.form.get('for', '').strip()
-    until_value = flask.request.form.get('until', '').strip()
+    form = flask.request.form
+    for_value = form.get('for', '').strip()
+    until_value = form.get('until', '').strip()
 
     if for_value and until_value:
-        raise RequestWithMultipleDurations(for_value=for_value, until_value=until_value)
+        raise MultipleDurations(for_value=for_value, until_value=until_value)
     elif for_value:
         return 'for', for_value
     elif until_value:
         return 'until', until_value
     else:
-        return 'for', DEFAULT_BLACKLIST_DURATION
+        return DEFAULT_DURATION
 
 
 # ERRORS
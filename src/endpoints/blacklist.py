@@ -9,11 +9,6 @@ import db
 import endpoints
 
 
-### CONFIGURATION ###
-
-DEFAULT_BLACKLIST_DURATION = '8 hours'
-
-
 ### ENDPOINTS ###
 
 @endpoints.endpoint('/blacklist', 'GET', 'reader')
@@ -33,9 +28,9 @@ def get_active_blacklist_entries_for_address(address):
 @endpoints.endpoint('/blacklist/<path:address>', 'POST', 'blacklister')
 def add_blacklist_entry(address):
     """Adds an IP address to the blacklist."""
-    duration, duration_type = endpoints.get_duration()
+    duration = endpoints.get_duration()
     user_name, comment = endpoints.get_user_name(), endpoints.get_comment()
-    results = db.blacklist.add_blacklist_entry(address, (duration, duration_type), user_name, comment)
+    results = db.blacklist.add_blacklist_entry(address, duration, user_name, comment)
     new_blacklist_entry, superseded_blacklist_entries, overlapping_blacklist_entries = results
     context.logger.info('Added %s to the blacklist.', address)
     response = flask.jsonify({
@@ -13,9 +13,8 @@ import utilities
 
 ### CONFIGURATION ###
 
-# Attributes that the error handler will add to the JSON response if they are present on an exception instance.
-# For best effect, do not use attributes that come alpabetically before 'message'. The keys in the JSON response are
-# ordered alphabetically (because caching), and something like 'hint' coming before the message might be confusing.
+# Attributes that the error handler will add to the JSON response if they are present on an exception instance. They
+# are added after the message, in this order.
 ATTRIBUTES_TO_ADD_TO_RESPONSE = ['note', 'solution']
 
 
@@ -44,6 +43,9 @@ class ServiceError(Exception):
     attribute `note` as `error.note`, and the attribute `solution` as `error.solution_template.format(**parameters)`,
     where `parameters` are the parameters passed to the constructor.)
 
+    Which template attributes exist is determined once per class, so templates that are only set on instances need to
+    be declared on the class as well (as `None`, say).
+
     Second, if an instance of a subclass defines the attribute `parameters_to_add_to_response` as a collection of names,
     any parameter with a name in that sequence that is passed to the constructor will be added to the response as is.
 
@@ -56,10 +58,29 @@ class ServiceError(Exception):
     status_code = 500
     parameters_to_add_to_response = []
 
+    # Derived from the attributes above for each subclass (see `__init_subclass__()`), so that the error handler
+    # doesn't need to work them out every time.
+    response_attribute_names = tuple(ATTRIBUTES_TO_ADD_TO_RESPONSE)
+    template_attribute_names = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.response_attribute_names = tuple(cls.parameters_to_add_to_response) + tuple(ATTRIBUTES_TO_ADD_TO_RESPONSE)
+        cls.template_attribute_names = tuple(
+            name for name in itertools.chain(['message'], ATTRIBUTES_TO_ADD_TO_RESPONSE)
+            if hasattr(cls, name + '_template'))
+
     def __init__(self, **parameters):
+        # Raising errors is common enough that it's worth doing everything in one place. Note that the preinitialization
+        # needs to come first, since it may set templates.
         self.perform_preinitialization(**parameters)
-        save_response_parameters(self, parameters)
-        format_response_attribute_templates(self, parameters)
+        for name in self.parameters_to_add_to_response:
+            if name in parameters:
+                setattr(self, name, parameters[name])
+        for name in self.template_attribute_names:
+            template = getattr(self, name + '_template')
+            if template:
+                setattr(self, name, template.format(**parameters))
 
     def perform_preinitialization(self, **parameters):
         """Does nothing, but can be overridden by subclasses, should the need arise."""
@@ -91,8 +112,9 @@ class NothingToDo(ServiceError):
 def handle_service_error(error):
     """Creates the JSON response that is returned to the user if a ServiceError is raised."""
     log_error(error)
-    contents = {'message': error.message}
+    contents = {}
     maybe_add_error_attribute_to_response(error, contents)
+    contents['message'] = error.message
     add_extra_attributes_to_response(error, contents)
     response = flask.jsonify(contents)
     response.status_code = error.status_code
@@ -116,21 +138,6 @@ def handle_unexpected_error(error):
 
 ### UTILITY FUNCTIONS ###
 
-def save_response_parameters(error, parameters):
-    """Saves any parameters passed to the given error's constructor that should be sent as part of the response."""
-    for name in error.parameters_to_add_to_response:
-        if name in parameters:
-            setattr(error, name, parameters[name])
-
-
-def format_response_attribute_templates(error, parameters):
-    """Formats any templates for attributes that should be sent as part of the response for the given error."""
-    for name in itertools.chain(['message'], ATTRIBUTES_TO_ADD_TO_RESPONSE):
-        template = getattr(error, name + '_template', None)
-        if template:
-            setattr(error, name, template.format(**parameters))
-
-
 def maybe_add_error_attribute_to_response(error, response_contents):
     """Adds the attribute `error` to the JSON response unless the exception does not actually indicate an error."""
     if error.status_code != 200:
@@ -139,7 +146,7 @@ def maybe_add_error_attribute_to_response(error, response_contents):
 
 def add_extra_attributes_to_response(error, response_contents):
     """Adds any extra attributes to the JSON response. See the documentation of `ServiceError` for details."""
-    for attribute in itertools.chain(error.parameters_to_add_to_response, ATTRIBUTES_TO_ADD_TO_RESPONSE):
+    for attribute in error.response_attribute_names:
         value = getattr(error, attribute, None)
         if value:
             response_contents[attribute] = value
@@ -156,11 +163,16 @@ def log_error(error):
     Logs the given error. Unexpected errors, and errors with status code 500 are logged as ERROR with stack trace,
     and user errors are logged as INFO without a stack trace.
     """
-    status_code = getattr(error, 'status_code', -1)
-    if status_code == 500:
-        context.logger.exception('')
-    elif status_code == -1:
-        context.logger.exception('There was an unexpected error!')
-    else:
+    message = ERROR_LOG_MESSAGES_BY_STATUS_CODE.get(getattr(error, 'status_code', -1))
+    if message is None:
         context.logger.info(error.message)
+    else:
+        context.logger.exception(message)
+
+
+# The messages with which errors that are logged as ERROR are logged, by status code (-1 for unexpected errors).
+ERROR_LOG_MESSAGES_BY_STATUS_CODE = {
+    500: '',
+    -1: 'There was an unexpected error!',
+}
 
@@ -3,12 +3,16 @@ Provides the `requires` decorator, which can be used to verify that the user has
 a given resource.
 """
 
-import dogpile.cache
+import cachetools
+import collections
 import flask
 import functools
+import hashlib
+import hmac
 import inspect
-import itertools
 import ldap3
+import os
+import threading
 
 import context
 import errors
@@ -18,6 +22,20 @@ import utilities
 ### CONFIGURATION ###
 
 ROLE_CACHE_EXPIRATION_TIME = 600  # seconds
+ROLE_CACHE_SIZE = 4096
+BAD_CREDENTIALS_CACHE_EXPIRATION_TIME = 60  # seconds
+BAD_CREDENTIALS_CACHE_SIZE = 4096
+
+
+### REQUEST STATE ###
+
+# The names of the attributes of `flask.g` that are used to remember things until the end of the request. They are
+# prefixed, so that they don't clash with anything else that's kept there. Always accessed using `flask.g.get()` or
+# `flask.g.setdefault()`, and set using `setattr()`.
+AUTHORIZED_ROLES_KEY = 'blockip_authorized_roles'
+USER_IDENTITY_KEY = 'blockip_user_identity'
+USER_ADDRESS_KEY = 'blockip_user_address'
+RESOURCE_KEY = 'blockip_resource'
 
 
 ### ROLES ###
@@ -51,11 +69,17 @@ IMPLIED_ROLES = {
 ### AUTHORIZATION ###
 
 def check_authorization(role, for_network=False):
-    """Raises NotAuthorized if the user isn't logged in or lacks the given role."""
+    """
+    Raises NotAuthorized if the user isn't logged in or lacks the given role. Successful checks are remembered until
+    the end of the request, so checking the same role again is free.
+    """
     authorization = flask.request.authorization
 
     if authorization and authorization.username:
-        check_permission(role, for_network)
+        authorized_roles = flask.g.setdefault(AUTHORIZED_ROLES_KEY, set())
+        if (role, for_network) not in authorized_roles:
+            check_permission(role, for_network)
+            authorized_roles.add((role, for_network))
     else:
         log_access_denied('They are not logged in.')
         raise NotLoggedIn()
@@ -90,13 +114,48 @@ def check_permission_unsafe(role, for_network):
 
 ### GETTING ROLES ###
 
-role_cache = dogpile.cache.make_region().configure('dogpile.cache.memory', expiration_time=ROLE_CACHE_EXPIRATION_TIME)
+# Both caches are keyed on the user name and a salted hash of the password (see `get_credentials_key()`), so that
+# passwords aren't kept in memory any longer than necessary. They aren't thread-safe by themselves, so they are only
+# accessed while holding `credentials_cache_lock`.
+role_cache = cachetools.TTLCache(maxsize=ROLE_CACHE_SIZE, ttl=ROLE_CACHE_EXPIRATION_TIME)
+
+# Remembers credentials that LDAP has rejected for a while, so that clients that keep sending bad credentials don't
+# cause a bind attempt every time.
+bad_credentials_cache = cachetools.TTLCache(
+    maxsize=BAD_CREDENTIALS_CACHE_SIZE, ttl=BAD_CREDENTIALS_CACHE_EXPIRATION_TIME)
+
+credentials_cache_lock = threading.Lock()
+
+# Generated anew for every process, since the hashes never leave the process.
+CREDENTIALS_KEY_SALT = os.urandom(32)
+
 
-@role_cache.cache_on_arguments()
 def get_roles(user_name, password):
     """Returns a set of the blockip roles of the user with the given credentials. May raise NotAuthorized."""
+    credentials_key = get_credentials_key(user_name, password)
+    with credentials_cache_lock:
+        has_bad_credentials = credentials_key in bad_credentials_cache
+        roles = role_cache.get(credentials_key)
+    if has_bad_credentials:
+        log_access_denied('They provided bad credentials (again).', use_user_name=False)
+        raise BadCredentials()
+    if roles is None:
+        # LDAP is asked without holding the lock, so that one slow request doesn't hold up all the others.
+        try:
+            roles = fetch_roles(user_name, password)
+        except BadCredentials:
+            with credentials_cache_lock:
+                bad_credentials_cache[credentials_key] = True
+            raise
+        with credentials_cache_lock:
+            role_cache[credentials_key] = roles
+    return roles
+
+
+def fetch_roles(user_name, password):
+    """As `get_roles()`, but always asks LDAP."""
     context.logger.info('Connecting to LDAP to authenticate user %s.', identify_user(use_user_name=False))
-    ldap_user = context.settings.get('ldap', 'user_name_template').format(user_name=user_name)
+    ldap_user = get_ldap_setting('user_name_template').format(user_name=user_name)
     with get_ldap_connection(ldap_user, password) as ldap_connection:
         roles_entries = search_for_roles(ldap_connection, user_name)
     role_names = extract_role_names(roles_entries)
@@ -104,25 +163,40 @@ def get_roles(user_name, password):
     return role_names
 
 
+def get_credentials_key(user_name, password):
+    """Returns a string that identifies the given credentials without containing the password."""
+    password_hash = hmac.new(CREDENTIALS_KEY_SALT, password.encode('UTF-8'), hashlib.sha256).hexdigest()
+    return user_name + ':' + password_hash
+
+
 def get_with_implied_roles(roles):
     """Returns a set of all roles that are in `roles` or are (directly or indirectly) implied by a role in `roles`."""
+    return set(get_frozen_with_implied_roles(frozenset(roles)))
+
+
+@functools.lru_cache(maxsize=1024)
+def get_frozen_with_implied_roles(roles):
+    """
+    As `get_with_implied_roles()`, but takes and returns a frozenset. The results are cached, since many users share
+    the same combination of roles.
+    """
     result = set(roles)
-    roles_to_check = list(roles)
+    roles_to_check = collections.deque(roles)
     while roles_to_check:
-        role = roles_to_check.pop(0)
+        role = roles_to_check.popleft()
         for implied_role in IMPLIED_ROLES.get(role, ()):
             if implied_role not in result:
                 result.add(implied_role)
-                roles_to_check.add(implied_role)
-    return result
+                roles_to_check.append(implied_role)
+    return frozenset(result)
 
 
 def get_ldap_connection(user_dn, password):
     """Returns an (open and bound) LDAP connection for the user with the given credentials."""
     try:
-        print(user_dn, password)
+        context.logger.debug('Binding to LDAP as %s.', user_dn)
         return ldap3.Connection(
-            ldap3.Server(context.settings.get('ldap', 'host'), use_ssl=context.settings.getboolean('ldap', 'use_ssl')),
+            get_ldap_server(),
             user=user_dn,
             password=password,
             auto_bind=ldap3.AUTO_BIND_TLS_BEFORE_BIND,
@@ -133,18 +207,30 @@ def get_ldap_connection(user_dn, password):
         raise BadCredentials()
 
 
+@functools.lru_cache(maxsize=None)
+def get_ldap_setting(name):
+    """Returns the value of the given setting from the `ldap` section of the configuration file. Cached."""
+    return context.settings.get('ldap', name)
+
+
+@functools.lru_cache(maxsize=None)
+def get_ldap_server():
+    """Returns the `ldap3.Server` for the LDAP server from the configuration file, which is only created once."""
+    return ldap3.Server(context.settings.get('ldap', 'host'), use_ssl=context.settings.getboolean('ldap', 'use_ssl'))
+
+
 def search_for_roles(ldap_connection, user_name):
     """Searches LDAP for the blockip roles of the user with the given name. Returns the unprocessed LDAP response."""
     ldap_connection.search(
-            context.settings.get('ldap', 'role_search_base'),
-            context.settings.get('ldap', 'role_search_filter_template').format(user_name=user_name),
+            get_ldap_setting('role_search_base'),
+            get_ldap_setting('role_search_filter_template').format(user_name=user_name),
             attributes=['cn'])
     return ldap_connection.response
 
 
 def extract_role_names(response):
     """Given an LDAP response as returned by `search_for_roles()`, returns the names of the roles that were found."""
-    return set(itertools.chain.from_iterable(item['attributes'].get('cn', ()) for item in response))
+    return {role_name for item in response for role_name in item['attributes'].get('cn', ())}
 
 
 ### ERRORS ###
@@ -168,13 +254,24 @@ class BadCredentials(NotAuthorized):
 class InsufficientRights(NotAuthorized):
     """Raised if the user lacks a role that is required to access a given resource."""
     status_code = 403
+    message_template = None  # Set by `perform_preinitialization()`.
+    solution_template = None  # Likewise.
 
     def perform_preinitialization(self, **parameters):
-        # context.settings is not yet available when the class is being created...
-        message_template_template = 'You do not have the role {role_path}, which is required to access this resource.'
-        role_path = context.settings.get('ldap', 'role_path_template', fallback='{role}')
-        self.message_template = message_template_template.format(role_path=role_path)
-        self.solution_template = context.settings.get('messages', 'missing_role_solution', fallback=None)
+        self.message_template, self.solution_template = get_insufficient_rights_templates()
+
+
+@functools.lru_cache(maxsize=None)
+def get_insufficient_rights_templates():
+    """
+    Returns the message and solution templates for `InsufficientRights`. These depend on the configuration, which is
+    not yet available when the class is being created, but doesn't change afterwards.
+    """
+    message_template_template = 'You do not have the role {role_path}, which is required to access this resource.'
+    role_path = context.settings.get('ldap', 'role_path_template', fallback='{role}')
+    message_template = message_template_template.format(role_path=role_path)
+    solution_template = context.settings.get('messages', 'missing_role_solution', fallback=None)
+    return message_template, solution_template
 
 
 class CannotTalkToLDAP(errors.EnvironmentError):
@@ -191,14 +288,28 @@ def log_access_denied(reason, use_user_name=True):
 
 
 def identify_user(use_user_name=True):
-    """Returns a string that identifies the user ("fgentner (192.0.2.1)", "192.0.2.1")."""
-    if use_user_name and flask.request.authorization:
-        return '{} ({})'.format(flask.request.authorization.username, flask.request.remote_addr)
-    else:
-        return flask.request.remote_addr
+    """
+    Returns a string that identifies the user ("fgentner (192.0.2.1)", "192.0.2.1"). The result is remembered until the
+    end of the request.
+    """
+    key = USER_IDENTITY_KEY if use_user_name else USER_ADDRESS_KEY
+    identity = flask.g.get(key)
+    if identity is None:
+        if use_user_name and flask.request.authorization:
+            identity = '{} ({})'.format(flask.request.authorization.username, flask.request.remote_addr)
+        else:
+            identity = flask.request.remote_addr
+        setattr(flask.g, key, identity)
+    return identity
 
 
 def identify_resource():
-    """Returns a string that identifies the resource the user is accessing ("GET /blocks", "POST /blocks/192.0.2.1")."""
-    return '{} {}'.format(flask.request.method, flask.request.path)
-
+    """
+    Returns a string that identifies the resource the user is accessing ("GET /blocks", "POST /blocks/192.0.2.1"). The
+    result is remembered until the end of the request.
+    """
+    resource = flask.g.get(RESOURCE_KEY)
+    if resource is None:
+        resource = flask.request.method + ' ' + flask.request.path
+        setattr(flask.g, RESOURCE_KEY, resource)
+    return resource
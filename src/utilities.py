@@ -5,8 +5,8 @@ Provides a number of generic utility functions.
 import collections
 import configparser
 import datetime
+import functools
 import ipaddress
-import json
 import logging
 import numbers
 import os
@@ -14,12 +14,16 @@ import os
 
 ### JSON ###
 
-class ISODatetimeJSONEncoder(json.JSONEncoder):
-    """A JSONEncoder that encodes datetime objects in ISO format (without the 'T')."""
-
-    def default(self, o):
-        if isinstance(o, datetime.datetime):
-            return o.isoformat(' ')
+def json_default(o):
+    """
+    Converts objects that JSON can't represent natively into something it can. Datetime objects are encoded in ISO format
+    (without the 'T'), and IP addresses and networks as strings. Raises `TypeError` for other objects.
+    """
+    if isinstance(o, datetime.datetime):
+        return o.isoformat(' ')
+    if isinstance(o, (ipaddress.IPv4Network, ipaddress.IPv6Network, ipaddress.IPv4Address, ipaddress.IPv6Address)):
+        return str(o)
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(o).__name__))
 
 
 ### TEXT FORMATTING ###
@@ -42,10 +46,16 @@ IGNORABLE_MODULES = {'__main__', 'builtins'}
 
 def get_qualified_class_name(o):
     """Returns the qualified name of the class of the given object, including the module it is defined in."""
-    module = o.__class__.__module__
+    return get_qualified_type_name(type(o))
+
+
+@functools.lru_cache(maxsize=None)
+def get_qualified_type_name(cls):
+    """As `get_qualified_class_name()`, but for the class itself. The results are cached, since there are few classes."""
+    module = cls.__module__
     module = '' if module in IGNORABLE_MODULES else module
     module = module + '.' if module else module
-    return module + o.__class__.__qualname__
+    return module + cls.__qualname__
 
 
 ### LOGGING ###
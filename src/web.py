@@ -3,7 +3,9 @@ Defines the main entrypoint for the blockip microservice.
 """
 
 import argparse
+import flask.json.provider
 import logging
+import orjson
 
 import context
 import endpoints
@@ -15,6 +17,29 @@ import utilities
 DEFAULT_CONFIGURATION_FILE_PATHS = ['./blockip.conf', '~/.blockip.conf']
 
 
+### JSON ###
+
+class OrjsonJSONProvider(flask.json.provider.DefaultJSONProvider):
+    """
+    A JSON provider that uses orjson, which is a lot faster than the standard library's json module, to serialize
+    responses. The output is compact (except in debug mode), and the keys are kept in the order in which they were
+    added, since sorting them would only cost time.
+    """
+
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=utilities.json_default, option=option).decode('UTF-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 ### COMMAND LINE ARGUMENTS ###
 
 def create_command_line_argument_parser():
@@ -40,7 +65,7 @@ def main(args=None):
     context.logger.info('Read configuration settings from %s.', utilities.and_join(configuration_file_paths_read))
     context.arguments = command_line_arguments
     context.settings = configuration_settings
-    context.app.json_encoder = utilities.ISODatetimeJSONEncoder
+    context.app.json = OrjsonJSONProvider(context.app)
     context.app.run(debug=command_line_arguments.debug)
 
 
@@ -1,14 +1,23 @@
 """
 A quick and dirty test script that runs the scenarios in scenarios/.
+
+The requests are sent using the `requests` package (see test-scenarios-requirements.txt) if it is installed, and using
+curl otherwise.
 """
 
 import datetime
 import os
 import pathlib
 import re
+import shlex
 import subprocess
 import sys
 
+try:
+    import requests
+except ImportError:
+    requests = None  # The commands are run using curl instead.
+
 
 DEFAULT_URL = 'http://127.0.0.1:5000'
 HERE = pathlib.Path(os.path.abspath(__name__)).parent
@@ -20,6 +29,11 @@ COMMAND_CREDENTIALS_PLACEHOLDER = '${USER}'
 RESPONSE_USER_NAME_PLACEHOLDER = 'fgentner'
 
 DATE_PATTERN_2XXX = re.compile(r'2\d{3}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}')
+# Matches either a date or the user name placeholder, so that responses can be normalized in a single pass.
+RESPONSE_NORMALIZATION_PATTERN = re.compile(
+    '({})|{}'.format(DATE_PATTERN_2XXX.pattern, re.escape(RESPONSE_USER_NAME_PLACEHOLDER)))
+
+FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
 
 
 def main():
@@ -28,11 +42,14 @@ def main():
     password = input('Your password > ')
     print()
 
+    # A single session is used for all requests, so that connections (and TLS sessions) can be reused.
+    session = requests.Session() if requests else None
+
     for scenario_path in scenario_paths():
         recreate_database()
         print('Running scenario {}...'.format(str(scenario_path.relative_to(SCENARIO_PATH))[:-4]))
         for command, expected_response in exchanges(scenario_path, url, user_name, password):
-            actual_response = run_command(command, user_name)
+            actual_response = run_command(command, user_name, session)
             print('    $', command)
             if expected_response and actual_response != expected_response:
                 print('    ERROR')
@@ -47,38 +64,81 @@ def main():
 
 def recreate_database():
     command = ['python', str(DATABASE_CREATION_SCRIPT_PATH), '-D']
-    output = subprocess.check_output(command, stderr=subprocess.STDOUT, cwd=str(HERE.parent)).decode('UTF-8')
+    output = subprocess.check_output(command, stderr=subprocess.STDOUT, cwd=str(HERE.parent), encoding='UTF-8')
     if 'ERROR' in output:
         print('Attempting to recreate the database caused one or more errors:')
         print('    ' + output.replace('\n', '\n    '))
         sys.exit(2)
 
 
-def run_command(command, user_name):
-    output = subprocess.check_output(command, stderr=subprocess.STDOUT, shell=True).decode('UTF-8')
-    output = DATE_PATTERN_2XXX.sub('<DATE>', output)
-    output = output.replace(RESPONSE_USER_NAME_PLACEHOLDER, user_name)
-    return output
+def run_command(command, user_name, session=None):
+    request = parse_curl_command(command) if session else None
+    if request:
+        # Like curl without -L, redirects aren't followed.
+        output = session.request(**request, allow_redirects=False).content.decode('UTF-8')
+    else:
+        output = subprocess.check_output(command, stderr=subprocess.STDOUT, shell=True, encoding='UTF-8')
+    return normalize_response(output, user_name)
+
+
+def parse_curl_command(command):
+    # Turns the simple curl commands used by the scenarios into keyword arguments for `requests.Session.request()`.
+    # Returns None for anything else, which is then left to the shell. Like curl, this sends the --data values as is.
+    try:
+        arguments = shlex.split(command)
+    except ValueError:
+        return None
+    if arguments[:2] != ['curl', '-Ss']:
+        return None
+    method, url, auth, data = None, None, None, []
+    arguments = arguments[2:]
+    while arguments:
+        argument = arguments.pop(0)
+        if argument in ('-X', '--user', '--data') and not arguments:
+            return None
+        elif argument == '-X':
+            method = arguments.pop(0)
+        elif argument == '--user':
+            auth = tuple(arguments.pop(0).split(':', 1))
+        elif argument == '--data':
+            data.append(arguments.pop(0))
+        elif argument.startswith('-') or url:
+            return None
+        else:
+            url = argument
+    if not url or (auth and len(auth) != 2):
+        return None
+    return {
+        'method': method or ('POST' if data else 'GET'),
+        'url': url,
+        'auth': auth,
+        'data': '&'.join(data) if data else None,
+        'headers': FORM_HEADERS if data else None,
+    }
+
+
+def normalize_response(response, user_name):
+    # Replaces dates with <DATE> and the user name placeholder with the actual user name, and drops trailing whitespace.
+    response = RESPONSE_NORMALIZATION_PATTERN.sub(lambda match: '<DATE>' if match.group(1) else user_name, response)
+    return response.rstrip()
 
 
 def exchanges(scenario_path, url, user_name, password):
     with scenario_path.open() as scenario_file:
         scenario = scenario_file.read()
     scenario = scenario.lstrip('$ ')
+    credentials = '{}:{}'.format(user_name, password)
+    tomorrow = (datetime.datetime.now() + datetime.timedelta(hours=24)).isoformat(' ')
     for chunk in scenario.split('\n$ '):
         if '\n' in chunk:
             command, response = chunk.split('\n', 1)
         else:
             command, response = chunk, ''
-        credentials = '{}:{}'.format(user_name, password)
-        tomorrow = (datetime.datetime.now() + datetime.timedelta(hours=24)).isoformat(' ')
         command = command.replace(COMMAND_URL_PLACEHOLDER, url)
         command = command.replace(COMMAND_CREDENTIALS_PLACEHOLDER, credentials)
         command = command.replace('curl', 'curl -Ss')
         command = DATE_PATTERN_2XXX.sub(tomorrow, command)
-        response = response.replace(RESPONSE_USER_NAME_PLACEHOLDER, user_name)
-        response = DATE_PATTERN_2XXX.sub('<DATE>', response)
-        response = response.rstrip()
+        response = normalize_response(response, user_name)
         yield command, response
 
 